@@ -1,15 +1,30 @@
-from pandas import DataFrame
+import numpy
+from sklearn.neighbors import BallTree
 from dataclasses import dataclass, InitVar, field
 from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 from .structures.stations import Station
 from .structures.trains import TrainSummary, Train, TrainStop
 from .structures.position import Position
 from .structures.paths import Rail, RoutingRule
-from .data_sources.osm import get_station_by_name, RailFinder
+from .data_sources.osm import get_stations_by_names, RailFinder
 from .data_sources.rozklad_pkp import get_train_urls_from_station, get_full_train_info
-from .routing import construct_rails_graph, find_rules_for_train, find_rule_for_path
+from .routing import RailsGraph, construct_rails_graph, find_rules_for_train, find_rule_for_path
 from .utils import log, oneshot_cache
 
+_CACHE_FIELDS = (
+    "_stations_tree",
+    "_usable_rails_cache",
+    "_rails_graph_cache",
+    "_station_pages",
+)  # not saved with the state
+
+
+def _station_coords(stations: list[Station]) -> tuple[numpy.ndarray, numpy.ndarray]:  # in radians
+    lat = numpy.fromiter((s.latitude for s in stations), dtype=numpy.float64, count=len(stations))
+    lon = numpy.fromiter((s.longitude for s in stations), dtype=numpy.float64, count=len(stations))
+    return numpy.deg2rad(lat), numpy.deg2rad(lon)
+
 
 @dataclass
 class ScraperState:
@@ -22,16 +37,19 @@ class ScraperState:
 
     # Scraper queues
     stations_to_locate: set[str] = field(default_factory=set)
-    stations_to_scrape: set[Station] = field(default_factory=set)
+    stations_to_scrape: dict[str, Station] = field(default_factory=dict)
     trains_to_scrape: list[TrainSummary] = field(default_factory=list)
 
     # Scraper helpers
     broken_stations: set[str] = field(default_factory=set)
     all_stops: dict[TrainStop, Train] = field(default_factory=dict)  # for fast lookup when handling duplicates
+    stops_by_train: dict[Train, set[TrainStop]] = field(default_factory=dict)  # inverse of all_stops
     blacklisted_trains: list[Train] = field(default_factory=list)  # alternative train numbers to ignore
+    trains_by_station: dict[str, set[Train]] = field(default_factory=dict)  # for fast lookup when deleting stations
+    known_trains: set[tuple[str, int]] = field(default_factory=set)  # (category, number) of scraped and blacklisted
 
     # Scraper results
-    stations: set[Station] = field(default_factory=set)
+    stations: dict[str, Station] = field(default_factory=dict)
     trains: list[Train] = field(default_factory=list)
 
     # Pathfinding queues
@@ -46,18 +64,56 @@ class ScraperState:
     rails: dict[tuple[str, str], Rail] = field(default_factory=dict)
     routing_rules: dict[tuple[str, str], RoutingRule] = field(default_factory=dict)
 
+    # Caches
+    _stations_tree: tuple[int, BallTree] | None = field(default=None, init=False, repr=False, compare=False)
+    _rails_version: int = field(default=0, init=False, repr=False, compare=False)  # bumped on every rail change
+    _usable_rails_cache: tuple[int, frozenset[Rail]] | None = field(default=None, init=False, repr=False, compare=False)
+    _rails_graph_cache: tuple[int, RailsGraph] | None = field(default=None, init=False, repr=False, compare=False)
+    _station_pages: dict[str, list[TrainSummary]] | None = field(default=None, init=False, repr=False, compare=False)
+
     def __post_init__(self, starting_station: str) -> None:
         self.stations_to_locate.add(starting_station)
 
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        for key in _CACHE_FIELDS:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:  # also migrates states saved by older versions
+        self.__dict__.update(state)
+        if isinstance(self.stations, set):
+            self.stations = {s.name: s for s in self.stations}
+        if isinstance(self.stations_to_scrape, set):
+            self.stations_to_scrape = {s.name: s for s in self.stations_to_scrape}
+        if "stops_by_train" not in state:
+            self.stops_by_train = {}
+            for stop, train in self.all_stops.items():
+                self.stops_by_train.setdefault(train, set()).add(stop)
+        if "trains_by_station" not in state:
+            self.trains_by_station = {}
+            for train in self.trains:
+                for stop in train.stops:
+                    self.trains_by_station.setdefault(stop.station_name, set()).add(train)
+        if "known_trains" not in state:
+            self.known_trains = {(t.category, t.number) for t in self.trains + self.blacklisted_trains}
+
     @property
     @oneshot_cache
-    def _usable_stations(self) -> set[Station]:
+    def _usable_stations(self) -> dict[str, Station]:
         return self.stations | self.stations_to_scrape
 
     @property
-    @oneshot_cache
     def _usable_rails(self) -> frozenset[Rail]:
-        return frozenset(self.rails.values()) | frozenset(self.rails_to_simplify.values())
+        if self._usable_rails_cache is None or self._usable_rails_cache[0] != self._rails_version:
+            rails = frozenset(self.rails.values()) | frozenset(self.rails_to_simplify.values())
+            self._usable_rails_cache = (self._rails_version, rails)
+        return self._usable_rails_cache[1]
+
+    def _rails_graph(self) -> RailsGraph:
+        if self._rails_graph_cache is None or self._rails_graph_cache[0] != self._rails_version:
+            self._rails_graph_cache = (self._rails_version, construct_rails_graph(self._usable_rails))
+        return self._rails_graph_cache[1]
 
     def get_export_data(self) -> dict:
         return {
@@ -67,7 +123,7 @@ class ScraperState:
                 "default_max_speed": self.default_max_speed,
                 "banned_categories": list(self.banned_categories),
             },
-            "stations": self._usable_stations,
+            "stations": list(self._usable_stations.values()),
             "trains": self.trains,
             "rails": list(self._usable_rails),
             "routing": list(self.routing_rules.values()),
@@ -81,52 +137,82 @@ class ScraperState:
 
     def _locate_stations(self) -> None:
         log("Locating stations...")
-        for station_name in self.stations_to_locate.copy():
-            station = get_station_by_name(station_name)
+        for station_name, station in get_stations_by_names(self.stations_to_locate).items():
             if station:
                 log(f"Located station: {station.name} at {station.latitude}, {station.longitude}")
-                self.stations_to_scrape.add(station)
+                self.stations_to_scrape[station.name] = station
             else:
                 log(f"Station '{station_name}' could not be located. Run `fixup stations` later to resolve manually.")
                 self.broken_stations.add(station_name)
             self.stations_to_locate.remove(station_name)
 
-    def _choose_station_to_scrape(self) -> Station:
+    def _scraped_stations_tree(self) -> BallTree:
+        if self._stations_tree is None or self._stations_tree[0] != len(self.stations):
+            lat, lon = _station_coords(list(self.stations.values()))
+            self._stations_tree = (len(self.stations), BallTree(numpy.column_stack((lat, lon)), metric="haversine"))
+        return self._stations_tree[1]
+
+    def _choose_stations_to_scrape(self, count: int) -> list[Station]:  # closest to already scraped ones first
+        candidates = list(self.stations_to_scrape.values())
         if not self.stations:
-            return next(iter(self.stations_to_scrape))
-        min_distance = float("inf")
-        chosen_station = None
-        for station in self.stations_to_scrape:
-            for scraped_station in self.stations:
-                d = station.distance_to(scraped_station)
-                if d < min_distance:
-                    min_distance = d
-                    chosen_station = station
-        return chosen_station  # type: ignore
-
-    def _scrape_station(self) -> None:
-        station = self._choose_station_to_scrape()
+            return candidates[:count]
+        lat, lon = _station_coords(candidates)
+        distances, _ = self._scraped_stations_tree().query(numpy.column_stack((lat, lon)), k=1)
+        return [candidates[i] for i in numpy.argsort(distances[:, 0], kind="stable")[:count]]
+
+    def _fetch_station_pages(self, stations: list[Station], jobs: int) -> None:
+        if self._station_pages is None:
+            self._station_pages = {}
+        missing = [s.name for s in stations if s.name not in self._station_pages]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pages = executor.map(lambda name: get_train_urls_from_station(name, self.day), missing)
+            self._station_pages.update(zip(missing, pages))
+
+    def _scrape_station(self, jobs: int) -> bool:
+        stations = self._choose_stations_to_scrape(jobs)  # the rest is only prefetched for later iterations
+        station = stations[0]
         log(f"Scraping station: {station.name}")
-        train_summaries = get_train_urls_from_station(station.name, self.day)
+        fetched = self._station_pages is None or station.name not in self._station_pages
+        if fetched:
+            self._fetch_station_pages(stations, jobs)
+        train_summaries = self._station_pages.pop(station.name)  # type: ignore
         for summary in train_summaries:
             if summary.category in self.banned_categories:
                 log(f"Skipping because of banned train category: {summary}")
                 continue
-            hs = hash(summary)
-            if all(hash(t) != hs for t in self.blacklisted_trains) and all(hash(t) != hs for t in self.trains):
+            if (summary.category, summary.number) not in self.known_trains:
                 self.trains_to_scrape.append(summary)
                 log(f"Found new train: {summary}")
-        self.stations_to_scrape.remove(station)
-        self.stations.add(station)
+        del self.stations_to_scrape[station.name]
+        self.stations[station.name] = station
+        return fetched
+
+    def _add_train(self, train: Train) -> None:
+        self.trains.append(train)
+        self.known_trains.add((train.category, train.number))
+        for stop in train.stops:
+            self.trains_by_station.setdefault(stop.station_name, set()).add(train)
+
+    def _blacklist_train(self, train: Train) -> None:
+        self.blacklisted_trains.append(train)
+        self.known_trains.add((train.category, train.number))
+
+    def _remove_train(self, train: Train) -> None:
+        self.trains.remove(train)
+        for stop in train.stops:
+            self.trains_by_station[stop.station_name].discard(train)
 
     def _find_duplicate_subtrain(self, train: Train) -> Train | None:
         if train in self.trains:
             found = next(t for t in self.trains if t == train)
             log(f"Duplicate subtrain detected by direct match: {found}")
             return found
+        shared_stops = self.all_stops.keys() & train.stops
+        if not shared_stops:
+            return None
         found = None
         for existing_stop in train.stops:
-            if existing_stop in self.all_stops:
+            if existing_stop in shared_stops:
                 if found == self.all_stops[existing_stop]:
                     log(
                         f"Duplicate subtrain detected based on multiple stops (example: {existing_stop.station_name}): {found}"
@@ -139,9 +225,12 @@ class ScraperState:
         found = self._find_duplicate_subtrain(train)
         if not found:
             return train
-        self.blacklisted_trains.extend((train, found))
-        self.trains.remove(found)
-        self.all_stops = {k: v for k, v in self.all_stops.items() if v != found}
+        self._blacklist_train(train)
+        self._blacklist_train(found)
+        self._remove_train(found)
+        for stop in self.stops_by_train.pop(found, ()):
+            if self.all_stops.get(stop) == found:
+                del self.all_stops[stop]
 
         result = found
         if len(train.stops) > len(found.stops):
@@ -156,53 +245,53 @@ class ScraperState:
         result.params.update(train.params)
         return result
 
-    def _scrape_train(self) -> None:
-        train_summary = self.trains_to_scrape[-1]
+    def _scrape_train(self, train_summary: TrainSummary, train: list[Train]) -> None:
         log(f"Scraping train: {train_summary}")
-        train = get_full_train_info(train_summary.url, train_summary.days)
         log(f"Train has {len(train)} subtrain(s).")
 
         filtered = [t for subtrain in train if (t := self._handle_duplicate_subtrain(subtrain))]
-        self.trains.extend(filtered)
 
         for subtrain in filtered:
+            self._add_train(subtrain)
             log(f"Analyzing subtrain: {subtrain}")
             for stop in subtrain.stops:
                 if stop.arrival_time is not None or stop.departure_time is not None:
                     self.all_stops[stop] = subtrain
-                dummy_station = Station(stop.station_name)
+                    self.stops_by_train.setdefault(subtrain, set()).add(stop)
                 if (
-                    dummy_station not in self.stations
-                    and dummy_station not in self.stations_to_scrape
+                    stop.station_name not in self.stations
+                    and stop.station_name not in self.stations_to_scrape
                     and stop.station_name not in self.broken_stations
                 ):
                     self.stations_to_locate.add(stop.station_name)
                     log(f"Found new station: {stop.station_name}")
         self.trains_to_scrape.pop()
 
-    def scrape(self) -> None:
+    def _scrape_trains(self, jobs: int) -> None:
+        summaries = self.trains_to_scrape[-jobs:][::-1]  # same order as scraping them one by one
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(get_full_train_info, s.url, s.days) for s in summaries]
+            for summary, future in zip(summaries, futures):
+                self._scrape_train(summary, future.result())
+
+    def scrape(self, jobs: int = 1) -> bool:  # whether PKP was queried in this iteration
         if self.stations_to_locate:
             self._locate_stations()
         elif self.trains_to_scrape:
-            self._scrape_train()
+            self._scrape_trains(jobs)
+            return True
         elif self.stations_to_scrape:
-            self._scrape_station()
+            return self._scrape_station(jobs)
+        return False
 
     def _cascade_station_deletion(self, station_name: str) -> tuple[list[Train], list[str]]:
-        trains_to_delete = []
-        for train in self.trains:
-            if any(stop.station_name == station_name for stop in train.stops):
-                trains_to_delete.append(train)
+        affected_trains = self.trains_by_station.get(station_name, set())
+        trains_to_delete = [train for train in self.trains if train in affected_trains]
         stations_to_delete = [station_name]
         for station in self.broken_stations:
             if station == station_name:
                 continue
-            for train in self.trains:
-                if train in trains_to_delete:
-                    continue
-                if any(stop.station_name == station for stop in train.stops):
-                    break
-            else:
+            if not self.trains_by_station.get(station, set()) - affected_trains:
                 stations_to_delete.append(station)
         return trains_to_delete, stations_to_delete
 
@@ -220,16 +309,16 @@ class ScraperState:
             raise ValueError("Station deletion aborted")
 
         for train in trains_to_delete:
-            self.trains.remove(train)
-            self.blacklisted_trains.append(train)
+            self._remove_train(train)
+            self._blacklist_train(train)
         for station in stations_to_delete:
             self.broken_stations.remove(station)
 
-    def fixup_stations(self, saved: DataFrame) -> None:
+    def fixup_stations(self, saved: dict[str, tuple[float, float]]) -> None:
         station = next(iter(self.broken_stations))
         log(f"Fixing station: {station}")
-        auto = saved[saved[0] == station]
-        if auto.empty:
+        auto = saved.get(station)
+        if auto is None:
             log(f"OpenStreetMap search: https://www.openstreetmap.org/search?query={station.replace(' ', '+')}")
             location = input("Paste OpenStreetMap location URL for a valid address or type 'delete': ")
             if location.strip().lower() == "delete":
@@ -242,21 +331,18 @@ class ScraperState:
                 )
             lat = float(location[-2])
             lon = float(location[-1])
-            saved.loc[len(saved)] = [station, lat, lon]
+            saved[station] = (lat, lon)
         else:
-            row = auto.iloc[0]
-            lat = float(row[1])
-            lon = float(row[2])
+            lat, lon = auto
             log(f"Using saved coordinates: {lat}, {lon}")
-        found_station = Station(station, Position(lat, lon))
-        self.stations.add(found_station)
+        self.stations[station] = Station(station, Position(lat, lon))
         self.broken_stations.remove(station)
         log("Station fixed successfully.")
 
     def _find_rails_from_station(self) -> None:
         station = next(iter(self.rails_to_find))
         log(f"Finding rails from station: {station.name}")
-        rails = RailFinder(station, self._usable_stations, self.default_max_speed).find_rails()
+        rails = RailFinder(station, self._usable_stations.values(), self.default_max_speed).find_rails()
         new_rails = {}
         for rail in rails:
             key = (rail.start_station.name, rail.end_station.name)
@@ -270,6 +356,7 @@ class ScraperState:
                 f"Updated station location to: {station.accurate_location.latitude}, {station.accurate_location.longitude}"
             )
         self.rails_to_simplify.update(new_rails)
+        self._rails_version += 1
         self.rails_to_find.remove(station)
 
     def _simplify_rail(self) -> None:
@@ -280,6 +367,7 @@ class ScraperState:
         original_points = len(rail.points)
         rail.simplify_by_resampling(self.rail_interval)
         self.rails[key] = rail
+        self._rails_version += 1
         log(
             f"Simplified rail - length: {original_length} -> {int(rail.length)} m, points: {original_points} -> {len(rail.points)}"
         )
@@ -294,7 +382,7 @@ class ScraperState:
             self._analyze_train_route()
 
     def reset_pathfinding(self, interval: int, speed: int, routing_only: bool = False) -> None:
-        for station in self._usable_stations:
+        for station in self._usable_stations.values():
             station.importance = 0
         self.trains_to_analyze = list(reversed(self.trains))
         self.routing_rules = {}
@@ -302,13 +390,14 @@ class ScraperState:
             log("Routing data has been reset.")
             return
 
-        for station in self._usable_stations:
+        for station in self._usable_stations.values():
             station.accurate_location = None
         self.rail_interval = interval
         self.default_max_speed = speed
-        self.rails_to_find = sorted(self._usable_stations, key=lambda s: s.name)
+        self.rails_to_find = sorted(self._usable_stations.values(), key=lambda s: s.name)
         self.rails_to_simplify = {}
         self.rails = {}
+        self._rails_version += 1
         self.broken_train_paths = []
         log(f"Initialized pathfinding state with interval of {interval} m and max speed of {speed} km/h.")
 
@@ -316,10 +405,9 @@ class ScraperState:
         train = self.trains_to_analyze[-1]
         log(f"Analyzing train route for: {train}")
         for stop in train.stops:
-            station = next(s for s in self._usable_stations if s.name == stop.station_name)
-            station.importance += 1
+            self._usable_stations[stop.station_name].importance += 1
 
-        graph = construct_rails_graph(self._usable_rails)
+        graph = self._rails_graph()
         new_rules, errors = find_rules_for_train(graph, train)
         for rule in new_rules:
             key = (rule.start_station, rule.end_station)
@@ -356,14 +444,15 @@ class ScraperState:
             case "d":
                 log("Adding direct rail.")
                 rail = Rail(
-                    next(s for s in self._usable_stations if s.name == start),
-                    next(s for s in self._usable_stations if s.name == end),
+                    self._usable_stations[start],
+                    self._usable_stations[end],
                     [],
                     [self.default_max_speed],
                     redundant=False,
                 )
                 key = (rail.start_station.name, rail.end_station.name)
                 self.rails[key] = rail
+                self._rails_version += 1
                 return True
             case "f" if via is not None:
                 log("Adding automatic route.")
@@ -382,7 +471,7 @@ class ScraperState:
     def fixup_routing(self) -> bool:
         train = self.broken_train_paths[-1]
         log(f"Fixing routing for train: {train}")
-        graph = construct_rails_graph(self._usable_rails)
+        graph = self._rails_graph()
         new_rules, errors = find_rules_for_train(graph, train)
         for rule in new_rules:
             key = (rule.start_station, rule.end_station)
@@ -408,14 +497,15 @@ class ScraperState:
     def add_rail(self, start: str, end: str, max_speed: int | None) -> None:
         log(f"Adding direct rail: {start} -> {end}")
         rail = Rail(
-            next(s for s in self._usable_stations if s.name == start),
-            next(s for s in self._usable_stations if s.name == end),
+            self._usable_stations[start],
+            self._usable_stations[end],
             [],
             [max_speed or self.default_max_speed],
             redundant=False,
         )
         key = (rail.start_station.name, rail.end_station.name)
         self.rails[key] = rail
+        self._rails_version += 1
         log(f"Direct rail added: {rail.start_station.name} -> {rail.end_station.name}")
 
     def delete_rail(self, start: str, end: str) -> None:
@@ -428,4 +518,5 @@ class ScraperState:
             del self.rails[key]
         if key in self.rails_to_simplify:
             del self.rails_to_simplify[key]
+        self._rails_version += 1
         log("Rail deleted successfully.")
@@ -1,37 +1,120 @@
+import math
+import os
+import pickle
 import osmnx
 import numpy
-from networkx import MultiGraph
+from networkx import Graph, MultiGraph
 from geopandas import GeoDataFrame
+from sklearn.neighbors import BallTree
 from heapq import heappop, heappush, heapify
+from threading import Thread
 from typing import Iterable, Generator
 from dataclasses import dataclass, field, InitVar
 from ..structures.stations import Station
-from ..structures.position import Position
+from ..structures.position import Position, EARTH_RADIUS_KM
 from ..structures.paths import Rail
-from ..utils import oneshot_cache
+from ..utils import log, oneshot_cache
 
 osmnx.settings.max_query_area_size = float("inf")
 osmnx.settings.cache_folder = "osmnx_cache"
 osmnx.settings.requests_timeout = 600
 
+_RAILS_CACHE_FILE = f"{osmnx.settings.cache_folder}/rails_graph_v2.pkl"  # bump version when processing changes
+_STATIONS_CACHE_FILE = f"{osmnx.settings.cache_folder}/stations_v1.pkl"  # bump version when processing changes
 _STATION_SEARCH_CUTOFF = 100_000  # in meters
+_STATION_SEARCH_CUTOFF_DEG = math.degrees(_STATION_SEARCH_CUTOFF / (EARTH_RADIUS_KM * 1000))  # latitude span
 _STATION_HITBOX_RADIUS = 150  # in meters
+_STATION_HITBOX_RADIUS_RAD = _STATION_HITBOX_RADIUS / (EARTH_RADIUS_KM * 1000)  # for haversine BallTree queries
 _LINE_SAMPLING_DISTANCE = 10  # in meters
 _AUGMENTED_EDGES_MULTIPLIER = 2.0
 _MAX_ANGLE_BETWEEN_RAILS = 75  # in degrees
+_MAX_ANGLE_COS = math.cos(math.radians(180 - _MAX_ANGLE_BETWEEN_RAILS))  # cosine of the sharpest allowed angle
+
+
+@dataclass
+class _StationTable:
+    rows: dict[str, int]  # name -> index into the coordinate arrays, unambiguous names only
+    latitudes: numpy.ndarray
+    longitudes: numpy.ndarray
+
+
+def _read_cache(path: str):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (EOFError, pickle.UnpicklingError):  # e.g. truncated by an older, non-atomic write
+        log(f"Ignoring corrupted cache file: {path}")
+        return None
+
+
+def _write_cache(path: str, value) -> None:
+    os.makedirs(osmnx.settings.cache_folder, exist_ok=True)
+    temp = f"{path}.tmp"
+    with open(temp, "wb") as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())  # the data must hit the disk before the rename does
+    os.replace(temp, path)
 
 
 @oneshot_cache
-def _all_stations() -> GeoDataFrame:
+def _all_stations() -> _StationTable:
+    cached = _read_cache(_STATIONS_CACHE_FILE)
+    if cached is not None:
+        return cached
     tags = {
         "railway": ["station", "halt"],
     }
-    gdf = osmnx.features_from_place("Poland", tags)  # type: ignore
-    return gdf
+    gdf: GeoDataFrame = osmnx.features_from_place("Poland", tags)  # type: ignore
+    rows: dict[str, int] = {}
+    ambiguous = set()
+    for i, name in enumerate(gdf["name"].tolist()):
+        if not isinstance(name, str):
+            continue
+        if name in rows:
+            ambiguous.add(name)
+        rows[name] = i
+    for name in ambiguous:  # ambiguous names can not be located
+        del rows[name]
+    points = gdf.geometry.representative_point()  # the point itself for nodes, a point inside for station areas
+    table = _StationTable(rows, points.y.to_numpy(dtype=numpy.float64), points.x.to_numpy(dtype=numpy.float64))
+    _write_cache(_STATIONS_CACHE_FILE, table)
+    return table
+
+
+def prefetch_stations() -> None:
+    Thread(target=_all_stations, daemon=True).start()  # overlaps the OSM query with the first PKP requests
+
+
+def _parse_max_speed(value: str | None) -> int | None:
+    try:
+        return int(value)  # type: ignore
+    except (TypeError, ValueError):
+        return None
+
+
+def _collapse_parallel_edges(graph: MultiGraph) -> Graph:
+    simple = Graph()
+    simple.add_nodes_from((node, {"y": data["y"], "x": data["x"]}) for node, data in graph.nodes(data=True))
+    for u, neighbors in graph.adjacency():
+        for v, edges in neighbors.items():
+            if simple.has_edge(u, v):
+                continue  # already added from the other end
+            data = {"length": min(d["length"] for d in edges.values())}
+            speeds = [s for d in edges.values() if (s := _parse_max_speed(d.get("maxspeed"))) is not None]
+            if speeds:
+                data["maxspeed"] = sum(speeds) / len(speeds)
+            simple.add_edge(u, v, **data)
+    return simple
 
 
 @oneshot_cache
-def _all_rails() -> MultiGraph:
+def _all_rails() -> Graph:
+    cached = _read_cache(_RAILS_CACHE_FILE)
+    if cached is not None:
+        return cached
     tags = '["railway"~"construction|rail"]'
     graph = osmnx.graph_from_place(
         "Poland",
@@ -39,39 +122,40 @@ def _all_rails() -> MultiGraph:
         simplify=False,
         retain_all=True,
     )
-    return graph.to_undirected()
+    graph = _collapse_parallel_edges(graph.to_undirected())  # only the shortest length and average speed are used
+    _write_cache(_RAILS_CACHE_FILE, graph)
+    return graph
 
 
-def get_station_by_name(name: str) -> Station | None:
-    name_fixed = name[:-5] if name.endswith(" (NŻ)") else name
-    stations = _all_stations()
-    matched = stations[stations["name"] == name_fixed]
-    if len(matched) != 1:
-        return None
-    matched = matched.iloc[0]
-    lat = float(matched.geometry.y)
-    long = float(matched.geometry.x)
-    return Station(name, Position(lat, long))
+@oneshot_cache
+def _rail_nodes_tree() -> tuple[numpy.ndarray, BallTree]:
+    graph = _all_rails()
+    node_ids = numpy.fromiter(graph.nodes, dtype=numpy.int64, count=graph.number_of_nodes())
+    coords = numpy.array([[data["y"], data["x"]] for _, data in graph.nodes(data=True)], dtype=numpy.float64)
+    return node_ids, BallTree(numpy.deg2rad(coords), metric="haversine")
 
 
-def _calculate_angle(p1: Position, p2: Position, p3: Position) -> float:
-    a = p1.to_array()
-    b = p2.to_array()
-    c = p3.to_array()
+def get_stations_by_names(names: Iterable[str]) -> dict[str, Station | None]:
+    stations = _all_stations()
+    result: dict[str, Station | None] = {}
+    for name in names:
+        row = stations.rows.get(name[:-5] if name.endswith(" (NŻ)") else name)
+        if row is None:
+            result[name] = None
+            continue
+        result[name] = Station(name, Position(float(stations.latitudes[row]), float(stations.longitudes[row])))
+    return result
 
-    ba = a - b
-    bc = c - b
-    norm_ba = numpy.linalg.norm(ba)
-    norm_bc = numpy.linalg.norm(bc)
 
-    if norm_ba == 0 or norm_bc == 0:
-        return 180.0
+def _calculate_angle_cos(p1: Position, p2: Position, p3: Position) -> float:
+    bax, bay = p1.latitude - p2.latitude, p1.longitude - p2.longitude
+    bcx, bcy = p3.latitude - p2.latitude, p3.longitude - p2.longitude
+    norm = math.sqrt((bax * bax + bay * bay) * (bcx * bcx + bcy * bcy))
 
-    cosine_angle = numpy.dot(ba, bc) / (norm_ba * norm_bc)
-    cosine_angle = numpy.clip(cosine_angle, -1.0, 1.0)
-    angle = numpy.arccos(cosine_angle)
+    if norm == 0:
+        return -1.0  # straight line
 
-    return float(numpy.degrees(angle))
+    return (bax * bcx + bay * bcy) / norm
 
 
 @dataclass(eq=False)
@@ -79,100 +163,130 @@ class RailFinder:
     starting_station: Station
     all_stations: InitVar[Iterable[Station]]
     default_speed: int
-    graph: MultiGraph = field(default_factory=_all_rails)
+    graph: Graph = field(default_factory=_all_rails)
+    graph_nodes_tree: tuple[numpy.ndarray, BallTree] = field(default_factory=_rail_nodes_tree)
 
     nearby_stations: list[Station] = field(init=False)
     nearby_stations_inclusive: list[Station] = field(init=False)
+    nearby_stations_tree: BallTree | None = field(init=False, default=None)
+    positions: dict[int, Position] = field(init=False)  # filled lazily for rail nodes
+    station_links: dict[int, list[int]] = field(init=False, default_factory=dict)  # rail node -> nearby stations
     priority_queue: list[tuple[float, int, bool]] = field(init=False, default_factory=list)
     distances: dict[int, float] = field(init=False, default_factory=dict)
     previous: dict[int, int] = field(init=False, default_factory=dict)
-    visited: set[int] = field(init=False, default_factory=set)
+    unreached_stations: set[int] = field(init=False)  # search ends early once all nearby stations are settled
 
     def __post_init__(self, all_stations: Iterable[Station]) -> None:
+        candidates = [s for s in all_stations if s != self.starting_station]
+        latitudes = numpy.fromiter((s.latitude for s in candidates), dtype=numpy.float64, count=len(candidates))
+        longitudes = numpy.fromiter((s.longitude for s in candidates), dtype=numpy.float64, count=len(candidates))
+        lat_margin = _STATION_SEARCH_CUTOFF_DEG
+        lon_margin = lat_margin / max(0.1, math.cos(math.radians(abs(self.starting_station.latitude) + lat_margin)))
+        in_box = numpy.flatnonzero(
+            (numpy.abs(latitudes - self.starting_station.latitude) <= lat_margin)
+            & (numpy.abs(longitudes - self.starting_station.longitude) <= lon_margin)
+        )  # cheap prefilter, only stations in the bounding box get the full haversine
+        distances = self.starting_station.location.distances_to(latitudes[in_box], longitudes[in_box])
         self.nearby_stations = [
-            s
-            for s in all_stations
-            if s != self.starting_station and self.starting_station.distance_to(s) < _STATION_SEARCH_CUTOFF
+            candidates[i] for i, d in zip(in_box.tolist(), distances.tolist()) if d < _STATION_SEARCH_CUTOFF
         ]
         self.nearby_stations_inclusive = self.nearby_stations + [self.starting_station]
+        self.positions = {s.augmented_node_id: s.location for s in self.nearby_stations_inclusive}
+        self.unreached_stations = {s.augmented_node_id for s in self.nearby_stations}
+        if self.nearby_stations:
+            coords = [[s.latitude, s.longitude] for s in self.nearby_stations]
+            self.nearby_stations_tree = BallTree(numpy.deg2rad(coords), metric="haversine")
+
+    def _link_nearby_stations(self) -> None:
+        if not self.nearby_stations:
+            return
+        node_ids, tree = self.graph_nodes_tree
+        coords = numpy.deg2rad([[s.latitude, s.longitude] for s in self.nearby_stations])
+        for station, hits in zip(self.nearby_stations, tree.query_radius(coords, r=_STATION_HITBOX_RADIUS_RAD)):
+            for node in node_ids[hits].tolist():
+                if station.location.distance_to(self._position_from_node(node)) <= _STATION_HITBOX_RADIUS:
+                    self.station_links.setdefault(node, []).append(station.augmented_node_id)
 
     def _init_collections(self) -> None:
-        for node in self.graph.nodes(data=True):
-            dist = self.starting_station.location.distance_to(Position(node[1]["y"], node[1]["x"]))
+        self._link_nearby_stations()
+        node_ids, tree = self.graph_nodes_tree
+        start = numpy.deg2rad([[self.starting_station.latitude, self.starting_station.longitude]])
+        for node in node_ids[tree.query_radius(start, r=_STATION_HITBOX_RADIUS_RAD)[0]].tolist():
+            dist = self.starting_station.location.distance_to(self._position_from_node(node))
             if dist > _STATION_HITBOX_RADIUS:
                 continue
             dist *= _AUGMENTED_EDGES_MULTIPLIER
-            self.priority_queue.append((dist, node[0], False))
-            self.distances[node[0]] = dist
-            self.previous[node[0]] = self.starting_station.augmented_node_id
+            self.priority_queue.append((dist, node, False))
+            self.distances[node] = dist
+            self.previous[node] = self.starting_station.augmented_node_id
         heapify(self.priority_queue)
 
     def _position_from_node(self, node: int) -> Position:
-        if node > 0:
-            return Position(self.graph.nodes[node]["y"], self.graph.nodes[node]["x"])
-        return next(filter(lambda s: s.augmented_node_id == node, self.nearby_stations_inclusive)).location
+        position = self.positions.get(node)
+        if position is None:
+            data = self.graph.nodes[node]
+            position = self.positions[node] = Position(data["y"], data["x"])
+        return position
 
     def _check_in_station_radius(self, u: int, v: int) -> bool:
         if u < 0 or v < 0:
             return True
+        if self.nearby_stations_tree is None:
+            return False
         p1 = self._position_from_node(u)
         p2 = self._position_from_node(v)
         line_distance = p1.distance_to(p2)
         num_samples = int(line_distance // _LINE_SAMPLING_DISTANCE) + 1
-        for i in range(num_samples + 1):
-            ratio = i / num_samples
-            sample_lat = p1.latitude + ratio * (p2.latitude - p1.latitude)
-            sample_lon = p1.longitude + ratio * (p2.longitude - p1.longitude)
-            sample_pos = Position(sample_lat, sample_lon)
-            for station in self.nearby_stations:
-                if station.location.distance_to(sample_pos) <= _STATION_HITBOX_RADIUS:
-                    return True
-        return False
+        ratios = numpy.linspace(0.0, 1.0, num_samples + 1)[:, None]
+        start = numpy.deg2rad([p1.latitude, p1.longitude])
+        end = numpy.deg2rad([p2.latitude, p2.longitude])
+        samples = start + ratios * (end - start)
+        hits = self.nearby_stations_tree.query_radius(samples, r=_STATION_HITBOX_RADIUS_RAD, count_only=True)
+        return bool(hits.any())
 
     def _get_neighbors(self, node: int) -> Generator[int, None, None]:
         if node < 0:
             return
-        for neighbor in self.graph.neighbors(node):
-            yield neighbor
-        for station in self.nearby_stations:
-            if station.location.distance_to(self._position_from_node(node)) <= _STATION_HITBOX_RADIUS:
-                yield station.augmented_node_id
+        yield from self.graph.neighbors(node)
+        yield from self.station_links.get(node, ())
 
-    def _get_edge_data(self, u: int, v: int) -> dict[int, dict]:
+    def _get_edge_data(self, u: int, v: int) -> dict:
         if u > 0 and v > 0:
-            return self.graph.get_edge_data(u, v)  # type: ignore
+            return self.graph[u][v]
         p1 = self._position_from_node(u)
         p2 = self._position_from_node(v)
         distance = p1.distance_to(p2) * _AUGMENTED_EDGES_MULTIPLIER
-        return {0: {"length": distance, "maxspeed": str(self.default_speed)}}
+        return {"length": distance, "maxspeed": self.default_speed}
 
     def _process_next_node(self) -> None:
         current_distance, current_node, in_station_radius = heappop(self.priority_queue)
-        if current_node in self.visited:
-            return  # already processed
+        if current_distance > self.distances[current_node]:
+            return  # outdated entry, a shorter path to this node has already been processed
+        if current_node < 0:
+            self.unreached_stations.discard(current_node)
+        distances = self.distances
+        previous_node = self.previous[current_node]
+        check_angle = current_node > 0 and previous_node > 0
+        previous_position = self._position_from_node(previous_node)
+        current_position = self._position_from_node(current_node)
         for neighbor in self._get_neighbors(current_node):
-            if current_node > 0 and neighbor > 0 and self.previous[current_node] > 0:
-                angle = _calculate_angle(
-                    self._position_from_node(self.previous[current_node]),
-                    self._position_from_node(current_node),
-                    self._position_from_node(neighbor),
+            if check_angle and neighbor > 0:
+                angle_cos = _calculate_angle_cos(
+                    previous_position, current_position, self._position_from_node(neighbor)
                 )
-                if 180 - angle > _MAX_ANGLE_BETWEEN_RAILS:
+                if angle_cos > _MAX_ANGLE_COS:
                     continue  # too sharp of an angle
-            edge_data = self._get_edge_data(current_node, neighbor)
-            edge_length = min(d["length"] for d in edge_data.values())
-            distance = current_distance + edge_length
-            if distance >= self.distances.get(neighbor, float("inf")) or distance > _STATION_SEARCH_CUTOFF:
+            distance = current_distance + self._get_edge_data(current_node, neighbor)["length"]
+            if distance >= distances.get(neighbor, float("inf")) or distance > _STATION_SEARCH_CUTOFF:
                 continue  # not a better path or too far
             neighbor_in_station_radius = distance >= 2 * _STATION_HITBOX_RADIUS and self._check_in_station_radius(
                 current_node, neighbor
             )
             if not neighbor_in_station_radius and in_station_radius:
                 continue  # stop at adjacent stations unless they are really close to origin
-            self.distances[neighbor] = distance
+            distances[neighbor] = distance
             self.previous[neighbor] = current_node
             heappush(self.priority_queue, (distance, neighbor, neighbor_in_station_radius))
-        self.visited.add(current_node)
 
     def _gather_rails(self) -> list[Rail]:
         rails = []
@@ -185,11 +299,7 @@ class RailFinder:
             while current != self.starting_station.augmented_node_id:
                 prev = self.previous[current]
                 if current > 0:
-                    edge_data = self._get_edge_data(prev, current)
-                    avg_speed = sum(int(d.get("maxspeed", str(self.default_speed))) for d in edge_data.values()) / len(
-                        edge_data
-                    )
-                    speeds.append(avg_speed)
+                    speeds.append(float(self._get_edge_data(prev, current).get("maxspeed", self.default_speed)))
                     path.append(self._position_from_node(current))
                 current = prev
             speeds.pop()
@@ -212,7 +322,7 @@ class RailFinder:
 
     def find_rails(self) -> list[Rail]:
         self._init_collections()
-        while self.priority_queue:
+        while self.priority_queue and self.unreached_stations:
             self._process_next_node()
         rails = self._gather_rails()
         self.starting_station.accurate_location = self._find_better_station_location(rails)
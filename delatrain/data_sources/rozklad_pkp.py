@@ -1,23 +1,60 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import date, time
-from bs4 import BeautifulSoup, Tag
+from lxml.etree import XPath
+from lxml.html import HtmlElement, HTMLParser, fromstring
 import re
+import sys
 from ..structures.stations import StationTrack
 from ..structures.trains import TrainSummary, TrainStop, Train
 
 _STATION_REQUEST_URL = "https://old.rozklad-pkp.pl/bin/trainsearch.exe/pn?ld=mobil&protocol=https:&="
-_REQUEST_ARGS = {
-    "headers": {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:146.0) Gecko/20100101 Firefox/146.0"},
-    "cookies": {"HAFAS-PROD-OLD-CL-SSL": "HAFAS-PROD-OLD-03"},
-}
+_REQUEST_HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:146.0) Gecko/20100101 Firefox/146.0"}
+_REQUEST_COOKIES = {"HAFAS-PROD-OLD-CL-SSL": "HAFAS-PROD-OLD-03"}  # per request, so the server cannot override it
+_MAX_CONNECTIONS = 32  # kept alive for parallel train scraping, opened only on demand
+_RETRY = Retry(
+    total=5,
+    backoff_factor=2.0,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=None,  # searches are POSTs, but repeating them is harmless
+    raise_on_status=True,  # a page still failing after all retries must not be parsed as an empty one
+)  # backs off when the server throttles parallel scraping, honoring Retry-After
 _TRAIN_NUMBER_REGEX = re.compile(r"^(\D+)(\d+)([^,]*),?$")
+_SESSION = requests.Session()  # reuses keep-alive connections between scraper iterations
+_SESSION.headers.update(_REQUEST_HEADERS)
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=_MAX_CONNECTIONS, max_retries=_RETRY))
+
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+_ROW_XPATH = XPath(f".//tr[{_has_class('zebracol-1')} or {_has_class('zebracol-2')}]")
+_CELLS_XPATH = XPath(".//td")
+_TEXT_XPATH = XPath(".//text()")
+_ERROR_MESSAGE_XPATH = XPath(f"//td[{_has_class('errormessage')}]")
+_ERROR_SELECT_XPATH = XPath(f"//select[{_has_class('error')}]")
+_SEARCH_FORM_ACTION_XPATH = XPath("//form[@name='ts_trainsearch']/@action")
+_ROUTE_CONTENT_XPATH = XPath("//div[@id='tq_trainroute_content_table_alteAnsicht']")
+_BOLD_SPAN_XPATH = XPath(f".//span[{_has_class('bold')}]")
+
+
+def _parse_html(response: requests.Response) -> HtmlElement:
+    response.raise_for_status()  # the iteration fails and is retried later instead of recording no trains
+    parser = HTMLParser(encoding=response.encoding or response.apparent_encoding)
+    return fromstring(response.content, parser=parser)  # bytes, as pages may carry an encoding declaration
+
+
+def _stripped_strings(element: HtmlElement) -> list[str]:
+    return [s.strip() for s in _TEXT_XPATH(element) if s.strip()]
 
 
 def _extract_train_number(full_number: str) -> tuple[str, int, str | None]:
     match = _TRAIN_NUMBER_REGEX.fullmatch(full_number)
     cat, num, name = match.groups()  # type: ignore
     name = name.strip()
-    return cat.strip(), int(num), name if name else None
+    return sys.intern(cat.strip()), int(num), name if name else None
 
 
 def _generate_payload(station: str, day: date, disambiguated: bool = False) -> dict[str, str]:
@@ -32,65 +69,62 @@ def _generate_payload(station: str, day: date, disambiguated: bool = False) -> d
     return payload
 
 
-def _ensure_disambiguated(html_raw: str, station: str, day: date) -> BeautifulSoup:
-    html = BeautifulSoup(html_raw, "lxml")
-    check = html.find("td", class_="errormessage")
+def _ensure_disambiguated(response: requests.Response, station: str, day: date) -> HtmlElement:
+    html = _parse_html(response)
+    check = _ERROR_MESSAGE_XPATH(html)
     if not check:
         return html
-    check = check.string.strip()  # type: ignore
-    if "jednoznaczne" not in check:
+    if "jednoznaczne" not in check[0].text_content().strip():
         return html
-    select = html.find("select", class_="error")
-    option = next(filter(lambda o: o.string.strip() == station, select.find_all("option")))  # type: ignore
-    value = str(option["value"])
-    url = str(html.find("form", attrs={"name": "ts_trainsearch"})["action"])  # type: ignore
+    select = _ERROR_SELECT_XPATH(html)[0]
+    option = next(o for o in select.iter("option") if o.text_content().strip() == station)
+    value = str(option.get("value"))
+    url = str(_SEARCH_FORM_ACTION_XPATH(html)[0])
     payload = _generate_payload(value, day, True)
-    response = requests.post(url, payload, **_REQUEST_ARGS)  # type: ignore
-    return BeautifulSoup(response.text, "lxml")
+    response = _SESSION.post(url, payload, cookies=_REQUEST_COOKIES)
+    return _parse_html(response)
 
 
 def get_train_urls_from_station(station_name: str, date: date) -> list[TrainSummary]:
-    response = requests.post(_STATION_REQUEST_URL, _generate_payload(station_name, date), **_REQUEST_ARGS)  # type: ignore
-    html = _ensure_disambiguated(response.text, station_name, date)
+    response = _SESSION.post(_STATION_REQUEST_URL, _generate_payload(station_name, date), cookies=_REQUEST_COOKIES)
+    html = _ensure_disambiguated(response, station_name, date)
     trains: list[TrainSummary] = []
-    for trs in html.find_all("tr", class_=["zebracol-1", "zebracol-2"]):
-        tds = trs.find_all("td")
-        full_number = next(tds[0].stripped_strings)
+    for trs in _ROW_XPATH(html):
+        tds = _CELLS_XPATH(trs)
+        full_number = _stripped_strings(tds[0])[0]
         category, number, _ = _extract_train_number(full_number)
-        url = tds[0].a["href"]  # type: ignore
-        days = tds[-1].string.strip()  # type: ignore
-        trains.append(TrainSummary(category, number, url, days))  # type: ignore
+        url = tds[0].find(".//a").get("href")
+        days = tds[-1].text_content().strip()
+        trains.append(TrainSummary(category, number, url, days))
     return trains
 
 
-def _parse_train(full_name: str, stations: list[Tag]) -> Train:
+def _parse_train(full_name: str, stations: list[HtmlElement]) -> Train:
     category, number, name = _extract_train_number(full_name)
     stops = []
     for row in stations:
-        tds = row.find_all("td")
-        station_name = tds[1].a.string.strip()  # type: ignore
-        arrival = tds[2].string.strip()  # type: ignore
+        tds = _CELLS_XPATH(row)
+        station_name = sys.intern(tds[1].find(".//a").text_content().strip())  # shared by every stop at the station
+        arrival = tds[2].text_content().strip()
         arrival_time = time.fromisoformat(arrival) if arrival else None
-        departure = tds[4 if len(tds) > 6 else 3].string.strip()  # type: ignore
+        departure = tds[4 if len(tds) > 6 else 3].text_content().strip()
         departure_time = time.fromisoformat(departure) if departure else None
-        track = tds[-1].string.strip() if len(tds) > 5 else None  # type: ignore
+        track = tds[-1].text_content().strip() if len(tds) > 5 else None
         track_parsed = StationTrack.from_pkp_string(track)
         stops.append(TrainStop(station_name, arrival_time, departure_time, track_parsed))
-    return Train(category, number, name, stops)
-
+    return Train(category, number, name, tuple(stops))
 
-def get_full_train_info(url: str, *additional_params: str) -> list[Train]:
-    response = requests.get(url, **_REQUEST_ARGS)  # type: ignore
-    html = BeautifulSoup(response.text, "lxml")
 
-    subtrains: list[tuple[str, list[Tag]]] = []
-    main_content = html.find("div", id="tq_trainroute_content_table_alteAnsicht")
+def _parse_full_train_html(html: HtmlElement, additional_params: tuple[str, ...]) -> list[Train]:
+    subtrains: list[tuple[str, list[HtmlElement]]] = []
+    main_content = _ROUTE_CONTENT_XPATH(html)
     if not main_content:
         return []
-    stations_table: Tag = main_content.table  # type: ignore
-    for row in stations_table.find_all("tr", class_=["zebracol-1", "zebracol-2"]):
-        tds = row.find_all("td")
-        full_name = tds[-2 if len(tds) > 5 else -1].string.strip()  # type: ignore
+    main_content = main_content[0]
+    stations_table = main_content.find(".//table")
+    for row in _ROW_XPATH(stations_table):
+        tds = _CELLS_XPATH(row)
+        full_name = tds[-2 if len(tds) > 5 else -1].text_content().strip()
         if not full_name:
             subtrains[-1][1].append(row)
             continue
@@ -99,14 +133,19 @@ def get_full_train_info(url: str, *additional_params: str) -> list[Train]:
         subtrains.append((full_name, [row]))
 
     trains = [_parse_train(f, s) for f, s in subtrains]
-    any_info = main_content.find("span", class_="bold")
+    any_info = _BOLD_SPAN_XPATH(main_content)
     if not any_info:
         for train in trains:
             train.params = set(additional_params)
         return trains
-    info: Tag = any_info.parent  # type: ignore
-    info_list = set(list(info.stripped_strings)[1:])
+    info = any_info[0].getparent()
+    info_list = set(_stripped_strings(info)[1:])
     info_list.update(additional_params)
     for train in trains:
         train.params = info_list
     return trains
+
+
+def get_full_train_info(url: str, *additional_params: str) -> list[Train]:
+    response = _SESSION.get(url, cookies=_REQUEST_COOKIES)
+    return _parse_full_train_html(_parse_html(response), additional_params)
@@ -1,33 +1,41 @@
-import pandas as pd
+import csv
 import pickle
 import signal
 import traceback
-import shutil
 import os
-import jsonpickle
+import io
+import shutil
+import orjson
 import zipfile
-from time import sleep, time
+from time import monotonic
+from threading import Event
 from typing import Callable
 from datetime import datetime, timedelta
 from argparse import ArgumentParser
 from functools import partial
 from .algorithm import ScraperState
+from .data_sources.osm import prefetch_stations
 from .utils import log
 
 
 _interrupted: int = 0
+_stop = Event()  # set on the first interrupt, wakes up any sleeping loop
 _sleep: float = 0.0
 
 OUTPUT_DIR = "output"
 STATE_FILE = f"{OUTPUT_DIR}/scraper_state.pkl"
 STATE_FILE_BACKUP = f"{OUTPUT_DIR}/scraper_state_backup.pkl"
+STATE_FILE_TEMP = f"{STATE_FILE}.tmp"
+STATE_FILE_BACKUP_TEMP = f"{STATE_FILE_BACKUP}.tmp"
 FIXUP_FILE = f"{OUTPUT_DIR}/station_fixups.csv"
 EXPORT_FILE = f"{OUTPUT_DIR}/delatrain"
+FILE_BUFFER_SIZE = 1 << 20
 
 
 def handle_interrupt(*_) -> None:
     global _interrupted
     _interrupted += 1
+    _stop.set()
     if _interrupted == 1:
         print("Interrupt received, saving state...")
     elif _interrupted == 5:
@@ -43,6 +51,9 @@ def get_parser() -> ArgumentParser:
     sub = parser.add_subparsers(dest="command", required=True, help="Subcommand to run.")
 
     scraper = sub.add_parser("scraper", aliases=["s"], help="Scrape PKP data.")
+    scraper.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Number of PKP pages to download in parallel (default: 1)."
+    )
     scraper_sub = scraper.add_subparsers(dest="scraper_command", required=True, help="Scraper subcommand to run.")
     scraper_sub.add_parser("continue", aliases=["c"], help="Resume scraping from saved state.")
     scraper_reset = scraper_sub.add_parser(
@@ -90,7 +101,7 @@ def get_parser() -> ArgumentParser:
 
 def read_state() -> ScraperState | None:
     try:
-        with open(STATE_FILE, "rb") as f:
+        with open(STATE_FILE, "rb", buffering=FILE_BUFFER_SIZE) as f:
             scraper_state = pickle.load(f)
         assert isinstance(scraper_state, ScraperState)
         log(
@@ -101,6 +112,16 @@ def read_state() -> ScraperState | None:
         log("Failed to load scraper state - fresh start required.")
 
 
+def _backup_state() -> None:  # the current state stays in place, so there is always one to resume from
+    if os.path.exists(STATE_FILE_BACKUP_TEMP):
+        os.remove(STATE_FILE_BACKUP_TEMP)  # left over from an interrupted save
+    try:
+        os.link(STATE_FILE, STATE_FILE_BACKUP_TEMP)
+    except OSError:
+        shutil.copy2(STATE_FILE, STATE_FILE_BACKUP_TEMP)  # filesystem without hard links
+    os.replace(STATE_FILE_BACKUP_TEMP, STATE_FILE_BACKUP)
+
+
 def graceful_shutdown(function: Callable[[ScraperState], None], state: ScraperState) -> None:
     signal.signal(signal.SIGINT, handle_interrupt)
     try:
@@ -110,69 +131,103 @@ def graceful_shutdown(function: Callable[[ScraperState], None], state: ScraperSt
         traceback.print_exception(e)
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    if os.path.exists(STATE_FILE_BACKUP) and os.path.exists(STATE_FILE):
-        os.remove(STATE_FILE_BACKUP)
-    if os.path.exists(STATE_FILE):
-        shutil.move(STATE_FILE, STATE_FILE_BACKUP)
     log("Saving started...")
-    with open(STATE_FILE, "wb") as f:
-        pickle.dump(state, f)
+    with open(STATE_FILE_TEMP, "wb", buffering=FILE_BUFFER_SIZE) as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())  # the data must hit the disk before the rename does
+    if os.path.exists(STATE_FILE):
+        _backup_state()
+    os.replace(STATE_FILE_TEMP, STATE_FILE)
     log("Scraper state saved. Exiting.")
 
 
-def scraper_main(state: ScraperState) -> None:
+def scraper_main(state: ScraperState, jobs: int) -> None:
     log("Starting scraping...")
-    while _interrupted == 0 and not state.is_scrape_finished():
-        time_start = time()
+    if not state.is_scrape_finished():
+        prefetch_stations()
+    while not _stop.is_set() and not state.is_scrape_finished():
+        time_start = monotonic()
         print("\n----------  New iteration of scraping  ----------")
-        state.scrape()
-        time_end = time()
+        queried = state.scrape(jobs)
+        time_end = monotonic()
         elapsed = time_end - time_start
-        if elapsed < _sleep:
-            sleep(_sleep - elapsed)
+        if queried and elapsed < _sleep:  # only iterations that queried PKP need pacing
+            _stop.wait(_sleep - elapsed)
 
 
 def fixup_stations_main(state: ScraperState) -> None:
     log("Starting station fix-up process...")
     log(f"{len(state.broken_stations)} stations need to be fixed.")
-    if not os.path.exists(FIXUP_FILE):
-        csv = pd.DataFrame(columns=[0, 1, 2])
-    else:
-        csv = pd.read_csv(FIXUP_FILE, header=None)
-    while _interrupted == 0 and state.broken_stations:
+    saved: dict[str, tuple[float, float]] = {}
+    if os.path.exists(FIXUP_FILE):
+        with open(FIXUP_FILE, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if row:
+                    saved.setdefault(row[0], (float(row[1]), float(row[2])))
+    while not _stop.is_set() and state.broken_stations:
         print("\n----------  New iteration of fix-up  ----------")
-        state.fixup_stations(csv)
-        sleep(_sleep)
-    csv.to_csv(FIXUP_FILE, index=False, header=False)
+        state.fixup_stations(saved)
+        _stop.wait(_sleep)
+    with open(FIXUP_FILE, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f, lineterminator="\n").writerows((name, lat, lon) for name, (lat, lon) in saved.items())
 
 
 def fixup_routing_main(state: ScraperState) -> None:
     log("Starting routing fix-up process...")
     log(f"{len(state.broken_train_paths)} trains need attention.")
     needs_restart = False
-    while _interrupted == 0 and not needs_restart and state.broken_train_paths:
+    while not _stop.is_set() and not needs_restart and state.broken_train_paths:
         print("\n----------  New iteration of fix-up  ----------")
         needs_restart = state.fixup_routing()
-        sleep(_sleep)
+        _stop.wait(_sleep)
     if needs_restart and state.broken_train_paths:
         print()
         log("Due to pathing changes, please restart this script to continue.")
 
 
+def _to_export_dict(obj) -> dict:
+    return obj.to_dict()
+
+
+def _write_indented(f: io.BufferedIOBase, encoder: Callable[..., bytes], option: int, data: dict) -> None:
+    f.write(b"{")  # same bytes as encoding all at once with OPT_INDENT_2, but one entity at a time
+    for i, (k, v) in enumerate(data.items()):
+        f.write((b",\n  " if i else b"\n  ") + orjson.dumps(k) + b": ")
+        if not isinstance(v, list) or not v:
+            f.write(encoder(v, option=option).replace(b"\n", b"\n  "))
+            continue
+        f.write(b"[")
+        for j, item in enumerate(v):
+            f.write((b",\n    " if j else b"\n    ") + encoder(item, option=option).replace(b"\n", b"\n    "))
+        f.write(b"\n  ]")
+    f.write(b"\n}" if data else b"}")
+
+
 def export_main(state: ScraperState, chunked: bool) -> None:
     log("Starting export...")
-    jsonpickle.set_encoder_options("json", ensure_ascii=False)
-    encoder = partial(jsonpickle.encode, unpicklable=False, make_refs=False, indent=2)
+    encoder = partial(orjson.dumps, default=_to_export_dict)
+    compact = orjson.OPT_PASSTHROUGH_DATACLASS  # dataclasses go through their to_dict
+    indented = compact | orjson.OPT_INDENT_2
     data = state.get_export_data()
     if not chunked:
-        with open(f"{EXPORT_FILE}.json", "w") as f:
-            f.write(encoder(data))  # type: ignore
+        with open(f"{EXPORT_FILE}.json", "wb", buffering=FILE_BUFFER_SIZE) as f:
+            _write_indented(f, encoder, indented, data)
         log(f"Exported as {EXPORT_FILE}.json")
         return
     with zipfile.ZipFile(f"{EXPORT_FILE}.zip", "w", zipfile.ZIP_DEFLATED) as f:
         for k, v in data.items():
-            f.writestr(f"{k}.json", encoder({k: v}, indent=None, separators=(",", ":")))  # type: ignore
-        f.writestr("index.json", encoder({"chunks": list(data.keys())}))  # type: ignore
+            with io.BufferedWriter(f.open(f"{k}.json", "w", force_zip64=True), FILE_BUFFER_SIZE) as chunk:
+                if not isinstance(v, list):
+                    chunk.write(encoder({k: v}, option=compact))
+                    continue
+                chunk.write(b"{" + orjson.dumps(k) + b":[")  # streamed one entity at a time
+                for i, item in enumerate(v):
+                    if i:
+                        chunk.write(b",")
+                    chunk.write(encoder(item, option=compact))
+                chunk.write(b"]}")
+        f.writestr("index.json", encoder({"chunks": list(data.keys())}, option=indented))
     log(f"Exported as {EXPORT_FILE}.zip")
 
 
@@ -181,10 +236,10 @@ def paths_main(state: ScraperState) -> None:
     if state.is_pathfinding_finished():
         log("Pathfinding is already finished or was never started.")
         return
-    while _interrupted == 0 and not state.is_pathfinding_finished():
+    while not _stop.is_set() and not state.is_pathfinding_finished():
         print("\n----------  New iteration of pathfinding  ----------")
         state.pathfind()
-        sleep(_sleep)
+        _stop.wait(_sleep)
 
 
 def select_sleep_time(args) -> None:
@@ -220,7 +275,7 @@ def main() -> None:
 
     match args.command:
         case "scraper" | "s":
-            graceful_shutdown(scraper_main, scraper_state)
+            graceful_shutdown(partial(scraper_main, jobs=max(1, args.jobs)), scraper_state)
         case "fixup" | "f":
             match args.fixup_command:
                 case "stations" | "s":
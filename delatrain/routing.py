@@ -1,6 +1,9 @@
-from networkx import Graph, shortest_path, NetworkXNoPath, NodeNotFound
-from .utils import oneshot_cache
+import numpy
+from dataclasses import dataclass, field
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from .structures.paths import RoutingRule, Rail
+from .structures.position import Position
 from .structures.trains import Train
 
 _MAX_PATH_LENGTH_MULTIPLIER = 3.5
@@ -8,44 +11,98 @@ _MAX_PATH_LENGTH_MULTIPLIER = 3.5
 RoutingErrors = dict[tuple[str, str], tuple[list[str], float] | None]
 
 
-@oneshot_cache
-def construct_rails_graph(rails: frozenset[Rail]) -> Graph:
-    graph = Graph()
+@dataclass
+class RailsGraph:
+    positions: dict[str, Position] = field(default_factory=dict)
+    rails: dict[tuple[str, str], Rail] = field(default_factory=dict)  # both directions
+    names: list[str] = field(default_factory=list)  # dense station ids used by the matrix
+    indices: dict[str, int] = field(default_factory=dict)
+    lengths: csr_matrix = field(default_factory=lambda: csr_matrix((0, 0)))
+
+
+def construct_rails_graph(rails: frozenset[Rail]) -> RailsGraph:
+    graph = RailsGraph()
     for rail in rails:
-        if not graph.has_node(rail.start_station.name):
-            graph.add_node(rail.start_station.name, pos=rail.start_station.location)
-        if not graph.has_node(rail.end_station.name):
-            graph.add_node(rail.end_station.name, pos=rail.end_station.location)
-        graph.add_edge(rail.start_station.name, rail.end_station.name, length=rail.length, rail=rail)
+        start, end = rail.start_station.name, rail.end_station.name
+        if start not in graph.indices:
+            graph.indices[start] = len(graph.names)
+            graph.names.append(start)
+            graph.positions[start] = rail.start_station.location
+        if end not in graph.indices:
+            graph.indices[end] = len(graph.names)
+            graph.names.append(end)
+            graph.positions[end] = rail.end_station.location
+        graph.rails[start, end] = graph.rails[end, start] = rail
+
+    rows = numpy.fromiter((graph.indices[r.start_station.name] for r in rails), dtype=numpy.int32, count=len(rails))
+    cols = numpy.fromiter((graph.indices[r.end_station.name] for r in rails), dtype=numpy.int32, count=len(rails))
+    lengths = numpy.fromiter((r.length for r in rails), dtype=numpy.float64, count=len(rails))
+    graph.lengths = csr_matrix((lengths, (rows, cols)), shape=(len(graph.names), len(graph.names)))
     return graph
 
 
-def find_rule_for_path(graph: Graph, start: str, end: str) -> tuple[RoutingRule | None, RoutingErrors]:
-    if graph.has_edge(start, end):
-        graph[start][end]["rail"].redundant = False
+def _find_paths(graph: RailsGraph, starts: list[int], limit: float) -> numpy.ndarray:  # predecessors, a row per start
+    _, predecessors = dijkstra(graph.lengths, directed=False, indices=starts, return_predecessors=True, limit=limit)
+    return predecessors
+
+
+def _trace_path(graph: RailsGraph, predecessors: numpy.ndarray, start: int, end: int) -> list[str] | None:
+    if start != end and predecessors[end] < 0:
+        return None
+    path = [end]
+    while path[-1] != start:
+        path.append(int(predecessors[path[-1]]))
+    return [graph.names[i] for i in reversed(path)]
+
+
+def find_rule_for_path(
+    graph: RailsGraph, start: str, end: str, predecessors: numpy.ndarray | None = None
+) -> tuple[RoutingRule | None, RoutingErrors]:
+    if (start, end) in graph.rails:
+        graph.rails[start, end].redundant = False
         return None, {}
-    try:
-        path = shortest_path(graph, start, end, weight="length")
-        path_length = sum(graph[path[j]][path[j + 1]]["length"] for j in range(len(path) - 1))
-        direct_length = graph.nodes[start]["pos"].distance_to(graph.nodes[end]["pos"])
-        via = path[1:-1]
-        if path_length > direct_length * _MAX_PATH_LENGTH_MULTIPLIER:
-            return None, {(start, end): (via, path_length / direct_length)}
-        rule = RoutingRule(start, end, via)
-        for j in range(len(path) - 1):
-            graph[path[j]][path[j + 1]]["rail"].redundant = False
-        return rule, {}
-    except (NetworkXNoPath, NodeNotFound):
+    if start not in graph.indices or end not in graph.indices:
         return None, {(start, end): None}
 
+    direct_length = graph.positions[start].distance_to(graph.positions[end])
+    max_length = direct_length * _MAX_PATH_LENGTH_MULTIPLIER
+    start_index, end_index = graph.indices[start], graph.indices[end]
+    if predecessors is None:
+        predecessors = _find_paths(graph, [start_index], max_length)[0]
+    path = _trace_path(graph, predecessors, start_index, end_index)
+    if path is None:  # either unreachable or too long, the full search tells which
+        path = _trace_path(graph, _find_paths(graph, [start_index], numpy.inf)[0], start_index, end_index)
+        if path is None:
+            return None, {(start, end): None}
+    path_rails = [graph.rails[path[j], path[j + 1]] for j in range(len(path) - 1)]
+    path_length = sum(rail.length for rail in path_rails)
+    via = path[1:-1]
+    if path_length > max_length:
+        return None, {(start, end): (via, path_length / direct_length)}
+    rule = RoutingRule(start, end, via)
+    for rail in path_rails:
+        rail.redundant = False
+    return rule, {}
+
+
+def find_rules_for_train(graph: RailsGraph, train: Train) -> tuple[list[RoutingRule], RoutingErrors]:
+    stop_names = [stop.station_name for stop in train.stops]
+    sections = list(zip(stop_names, stop_names[1:]))
+
+    # One Dijkstra run from all distinct section starts, limited by the longest acceptable section
+    starts: dict[str, int] = {}
+    limit = 0.0
+    for start, end in sections:
+        if (start, end) not in graph.rails and start in graph.indices and end in graph.indices:
+            starts.setdefault(start, len(starts))
+            limit = max(limit, graph.positions[start].distance_to(graph.positions[end]) * _MAX_PATH_LENGTH_MULTIPLIER)
+    predecessors = _find_paths(graph, [graph.indices[s] for s in starts], limit) if starts else None
 
-def find_rules_for_train(graph: Graph, train: Train) -> tuple[list[RoutingRule], RoutingErrors]:
     rules = []
     errors = {}
-    for i in range(len(train.stops) - 1):
-        start = train.stops[i].station_name
-        end = train.stops[i + 1].station_name
-        rule, error = find_rule_for_path(graph, start, end)
+    for start, end in sections:
+        start_predecessors = predecessors[starts[start]] if start in starts else None  # type: ignore
+        rule, error = find_rule_for_path(graph, start, end, start_predecessors)
         if rule is not None:
             rules.append(rule)
         errors |= error
@@ -1,39 +1,20 @@
 from dataclasses import dataclass, field
-from networkx import DiGraph
-from jsonpickle import handlers
-from .position import Position
+import numpy
+from .position import Position, haversine_distances, path_length
 from .stations import Station
+from ..utils import dataclass_setstate
 
 
-def _find_point_at_distance(
-    graph: DiGraph, start_position: Position, distance: float
-) -> tuple[list[Position], Position | None]:  # returns (visited_points + next_point, interpolated_point)
-    visited_points = []
-    accumulated_distance = 0.0
-    current_position = start_position
-    while True:
-        next_position = next(graph.successors(current_position), None)
-        if not next_position:
-            return visited_points, None
-        segment_distance = current_position.distance_to(next_position)
-        visited_points.append(next_position)
-        if accumulated_distance + segment_distance >= distance:
-            ratio = (distance - accumulated_distance) / segment_distance
-            interpolated_x = current_position.longitude + ratio * (next_position.longitude - current_position.longitude)
-            interpolated_y = current_position.latitude + ratio * (next_position.latitude - current_position.latitude)
-            interpolated_point = Position(latitude=interpolated_y, longitude=interpolated_x)
-            return visited_points, interpolated_point
-        accumulated_distance += segment_distance
-        current_position = next_position
-
-
-@dataclass(unsafe_hash=True)
+@dataclass(unsafe_hash=True, slots=True)
 class Rail:
     start_station: Station
     end_station: Station
     points: list[Position] = field(compare=False, hash=False, default_factory=list)
     max_speed: list[float] = field(compare=False, hash=False, default_factory=list)  # in km/h
     redundant: bool = field(compare=False, hash=False, default=True)
+    _length: float | None = field(default=None, init=False, repr=False, compare=False)  # reset when points change
+
+    __setstate__ = dataclass_setstate
 
     def __post_init__(self):
         if self.start_station.name < self.end_station.name:
@@ -44,19 +25,13 @@ class Rail:
 
     @property
     def length(self) -> float:  # in kilometers
-        full_points = [self.start_station.best_location()] + self.points + [self.end_station.best_location()]
-        return sum(full_points[i].distance_to(full_points[i + 1]) for i in range(len(full_points) - 1))
-
-    def construct_graph(self) -> DiGraph:
-        graph = DiGraph()
-        for i in range(len(self.points) - 1):
-            p1 = self.points[i]
-            p2 = self.points[i + 1]
-            speed = self.max_speed[i]
-            graph.add_edge(p1, p2, speed=speed)
-        return graph
+        if self._length is None:
+            full_points = [self.start_station.best_location()] + self.points + [self.end_station.best_location()]
+            self._length = path_length(full_points)
+        return self._length
 
     def extend_ends(self, default_speed: int) -> None:
+        self._length = None
         if self.points[0] != self.start_station.best_location():
             self.points.insert(0, self.start_station.best_location())
             self.max_speed.insert(0, float(default_speed))
@@ -65,93 +40,93 @@ class Rail:
             self.max_speed.append(float(default_speed))
 
     def simplify_by_resampling(self, interval: int) -> None:  # interval in meters
-        graph = self.construct_graph()
+        self._length = None
+        latitudes = numpy.fromiter((p.latitude for p in self.points), dtype=numpy.float64, count=len(self.points))
+        longitudes = numpy.fromiter((p.longitude for p in self.points), dtype=numpy.float64, count=len(self.points))
+        speeds = numpy.asarray(self.max_speed, dtype=numpy.float64)
+        segments = haversine_distances(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+        cumulative = numpy.concatenate(([0.0], numpy.cumsum(segments)))
+
+        new_points = [self.points[0]]
+        new_max_speed = []
         current_point = self.points[0]
+        next_index = 1  # first original point after current_point
+        current_distance = segments[0]  # from current_point to the next original point
         while True:
-            visited_points, interpolated_point = _find_point_at_distance(graph, current_point, interval)
-            if not interpolated_point:  # We have reached the end
+            target = interval - current_distance + cumulative[next_index]
+            reached = next_index + int(numpy.searchsorted(cumulative[next_index:], target))
+            if reached == len(self.points):  # We have reached the end
                 break
-            if len(visited_points) == 1:  # Interval is shorter than the next segment
-                current_point = visited_points[0]
+            if reached == next_index:  # Interval is shorter than the next segment
+                current_point = self.points[next_index]
+                new_points.append(current_point)
+                new_max_speed.append(float(speeds[next_index - 1]))
+                next_index += 1
+                if next_index == len(self.points):
+                    break
+                current_distance = segments[next_index - 1]
                 continue
 
-            speed = float("inf")
-            speed_current_point = current_point
-            edge_data = None
-            for vp in visited_points:
-                edge_data = graph.get_edge_data(speed_current_point, vp)
-                assert edge_data is not None
-                speed = min(speed, edge_data["speed"])
-                speed_current_point = vp
-
-            graph.remove_nodes_from(visited_points[:-1])
-            graph.add_edge(current_point, interpolated_point, speed=speed)
-            graph.add_edge(interpolated_point, visited_points[-1], speed=edge_data["speed"])  # type: ignore
-            current_point = interpolated_point
+            accumulated_distance = current_distance + cumulative[reached - 1] - cumulative[next_index]
+            ratio = (interval - accumulated_distance) / segments[reached - 1]
+            previous_point = self.points[reached - 1]
+            next_point = self.points[reached]
+            current_point = Position(
+                latitude=previous_point.latitude + ratio * (next_point.latitude - previous_point.latitude),
+                longitude=previous_point.longitude + ratio * (next_point.longitude - previous_point.longitude),
+            )
+            new_points.append(current_point)
+            new_max_speed.append(float(speeds[next_index - 1 : reached].min()))
+            next_index = reached
+            current_distance = current_point.distance_to(next_point)
+        new_points.extend(self.points[next_index:])
+        new_max_speed.extend(float(speed) for speed in speeds[next_index - 1 :])
 
         # Handle the last segment to the end point by merging
-        last_point = self.points[-1]
         speed = float("inf")
-        speed_current_point = last_point
+        merged_index = len(new_points) - 1
         accumulated_distance = 0.0
-        while True:
-            predecessor = next(graph.predecessors(speed_current_point), None)
-            if not predecessor:
-                break
-            edge_data = graph.get_edge_data(predecessor, speed_current_point)
-            assert edge_data is not None
-            speed = min(speed, edge_data["speed"])
-            segment_distance = predecessor.distance_to(speed_current_point)
-            accumulated_distance += segment_distance
+        while merged_index > 0:
+            speed = min(speed, new_max_speed[merged_index - 1])
+            accumulated_distance += new_points[merged_index - 1].distance_to(new_points[merged_index])
             if accumulated_distance >= interval:
                 break
-            graph.remove_node(speed_current_point)
-            speed_current_point = predecessor
-        graph.add_edge(speed_current_point, last_point, speed=speed)
-
-        # Remove cycles if any
-        cycles = [(u, v) for u, v in graph.edges() if u == v]
-        graph.remove_edges_from(cycles)
+            merged_index -= 1
+        if merged_index < len(new_points) - 1:
+            new_points[merged_index + 1 :] = [new_points[-1]]
+            new_max_speed[merged_index:] = [speed]
 
-        # Reconstruct points and max_speed from the simplified graph
-        new_points = [self.points[0]]
-        new_max_speed = []
-        while True:
-            next_point = next(graph.successors(new_points[-1]), None)
-            if not next_point:
-                break
-            edge_data = graph.get_edge_data(new_points[-1], next_point)
-            assert edge_data is not None
-            new_max_speed.append(edge_data["speed"])
-            new_points.append(next_point)
         self.points = new_points
         self.max_speed = new_max_speed
         assert len(self.points) - 1 == len(self.max_speed)
 
+    def to_dict(self) -> dict:
+        return {
+            "start_station": self.start_station.name,
+            "end_station": self.end_station.name,
+            "points": [p.to_dict() for p in self.points],
+            "max_speed": self.max_speed,
+            "redundant": self.redundant,
+        }
 
-@handlers.register(Rail)  # type: ignore
-class RailHandler(handlers.BaseHandler):
-    def flatten(self, obj, data):
-        data["start_station"] = obj.start_station.name
-        data["end_station"] = obj.end_station.name
-        data["points"] = [p.__getstate__() for p in obj.points]
-        data["max_speed"] = obj.max_speed
-        data["redundant"] = obj.redundant
-        return data
 
-
-@dataclass(unsafe_hash=True)
+@dataclass(unsafe_hash=True, slots=True)
 class RoutingRule:
     start_station: str
     end_station: str
     via: list[str] = field(compare=False, hash=False, default_factory=list)
 
+    __setstate__ = dataclass_setstate
+
     def __post_init__(self):
         if self.start_station < self.end_station:
             return
         self.start_station, self.end_station = self.end_station, self.start_station
         self.via.reverse()
-    
+
     @property
     def full_path(self) -> list[str]:
         return [self.start_station] + self.via + [self.end_station]
+
+    def to_dict(self) -> dict:
+        return {"start_station": self.start_station, "end_station": self.end_station, "via": self.via}
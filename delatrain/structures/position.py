@@ -1,33 +1,68 @@
 import numpy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Self
 from math import radians, sin, cos, sqrt, atan2
 
-_EARTH_RADIUS_KM = 6371.0
+EARTH_RADIUS_KM = 6371.0
 
 
-@dataclass(frozen=True)
+def haversine_distances(lat1, lon1, lat2, lon2) -> numpy.ndarray:  # vectorized, in meters
+    lat1 = numpy.radians(lat1)
+    lon1 = numpy.radians(lon1)
+    lat2 = numpy.radians(lat2)
+    lon2 = numpy.radians(lon2)
+
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    a = numpy.sin(dlat / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2) ** 2
+    c = 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+    return EARTH_RADIUS_KM * c * 1000
+
+
+def path_length(positions: list["Position"]) -> float:  # in meters
+    latitudes = numpy.fromiter((p.latitude for p in positions), dtype=numpy.float64, count=len(positions))
+    longitudes = numpy.fromiter((p.longitude for p in positions), dtype=numpy.float64, count=len(positions))
+    return float(haversine_distances(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]).sum())
+
+
+@dataclass(frozen=True, slots=True)
 class Position:
     latitude: float
     longitude: float
+    _latitude_rad: float = field(init=False, repr=False, compare=False)  # derived, not pickled
+    _longitude_rad: float = field(init=False, repr=False, compare=False)
+    _latitude_cos: float = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_latitude_rad", radians(self.latitude))
+        object.__setattr__(self, "_longitude_rad", radians(self.longitude))
+        object.__setattr__(self, "_latitude_cos", cos(self._latitude_rad))
+
+    def __getstate__(self) -> dict:
+        return {"latitude": self.latitude, "longitude": self.longitude}
+
+    def __setstate__(self, state: dict) -> None:
+        object.__setattr__(self, "latitude", state["latitude"])
+        object.__setattr__(self, "longitude", state["longitude"])
+        self.__post_init__()
 
     @classmethod
     def unknown(cls) -> Self:
         return cls(float("nan"), float("nan"))
 
     def distance_to(self, other: Self) -> float:  # haversine formula, in meters
-        lat1 = radians(self.latitude)
-        lon1 = radians(self.longitude)
-        lat2 = radians(other.latitude)
-        lon2 = radians(other.longitude)
-
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
+        dlat = other._latitude_rad - self._latitude_rad
+        dlon = other._longitude_rad - self._longitude_rad
 
-        a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+        a = sin(dlat / 2) ** 2 + self._latitude_cos * other._latitude_cos * sin(dlon / 2) ** 2
         c = 2 * atan2(sqrt(a), sqrt(1 - a))
 
-        return _EARTH_RADIUS_KM * c * 1000
+        return EARTH_RADIUS_KM * c * 1000
+
+    def to_dict(self) -> dict:
+        return {"latitude": self.latitude, "longitude": self.longitude}
 
-    def to_array(self) -> numpy.ndarray:
-        return numpy.array([self.latitude, self.longitude])
+    def distances_to(self, latitudes: numpy.ndarray, longitudes: numpy.ndarray) -> numpy.ndarray:  # in meters
+        return haversine_distances(self.latitude, self.longitude, latitudes, longitudes)
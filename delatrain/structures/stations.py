@@ -1,8 +1,8 @@
 from dataclasses import dataclass, field
 from typing import Self
-from functools import cached_property
-from jsonpickle import handlers
+from functools import lru_cache
 from .position import Position
+from ..utils import dataclass_setstate
 
 _ROMAN_NUMERALS = {
     "I": 1,
@@ -15,24 +15,22 @@ _ROMAN_NUMERALS = {
 }
 
 
+@lru_cache(maxsize=128)  # platforms repeat constantly
 def _roman_numeral_to_decimal(s: str) -> int:
-    total = 0
-    prev_value = 0
-    for char in s:
-        value = _ROMAN_NUMERALS.get(char.upper(), 0)
-        if value > prev_value:
-            total += value - 2 * prev_value
-        else:
-            total += value
-        prev_value = value
+    values = [_ROMAN_NUMERALS.get(char, 0) for char in s.upper()]
+    total = values[-1] if values else 0
+    for value, next_value in zip(values, values[1:]):
+        total += -value if value < next_value else value
     return total
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class StationTrack:
     platform: int
     track: str
 
+    __setstate__ = dataclass_setstate
+
     @classmethod
     def from_pkp_string(cls, s: str | None) -> Self | None:
         if not s:
@@ -42,13 +40,19 @@ class StationTrack:
             return None
         return cls(_roman_numeral_to_decimal(parts[0]), parts[1])
 
+    def to_dict(self) -> dict:
+        return {"platform": self.platform, "track": self.track}
+
 
-@dataclass(unsafe_hash=True)
+@dataclass(unsafe_hash=True, slots=True)
 class Station:
     name: str
     location: Position = field(compare=False, hash=False, default=Position.unknown())
     importance: int = field(compare=False, hash=False, default=0)  # number of trains stopping here
     accurate_location: Position | None = field(compare=False, hash=False, default=None)  # after finding rails
+    _augmented_node_id: int | None = field(default=None, init=False, repr=False, compare=False)
+
+    __setstate__ = dataclass_setstate
 
     @property
     def latitude(self) -> float:
@@ -58,22 +62,17 @@ class Station:
     def longitude(self) -> float:
         return self.location.longitude
 
-    @cached_property
+    @property
     def augmented_node_id(self) -> int:
-        return -abs(hash(self))
-    
+        if self._augmented_node_id is None:
+            self._augmented_node_id = -abs(hash(self))
+        return self._augmented_node_id
+
     def best_location(self) -> Position:
         return self.accurate_location if self.accurate_location else self.location
 
     def distance_to(self, other: Self) -> float:  # in meters
         return self.location.distance_to(other.location)
 
-
-@handlers.register(Station)  # type: ignore
-class StationHandler(handlers.BaseHandler):
-    def flatten(self, obj, data):
-        data["name"] = obj.name
-        location = obj.best_location()
-        data["location"] = location.__getstate__()
-        data["importance"] = obj.importance
-        return data
+    def to_dict(self) -> dict:
+        return {"name": self.name, "location": self.best_location().to_dict(), "importance": self.importance}
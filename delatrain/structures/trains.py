@@ -1,34 +1,58 @@
 from dataclasses import dataclass, field
 from datetime import time
 from .stations import StationTrack
+from ..utils import dataclass_setstate
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class TrainSummary:
     category: str
     number: int
     url: str = field(compare=False, hash=False)
     days: str = field(compare=False, hash=False)
 
+    __setstate__ = dataclass_setstate
+
     def __str__(self) -> str:
         return f"{self.category} {self.number}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class TrainStop:
     station_name: str
     arrival_time: time | None
     departure_time: time | None
     track: StationTrack | None = field(compare=False, hash=False)
 
+    __setstate__ = dataclass_setstate
+
+    def to_dict(self) -> dict:
+        return {
+            "station_name": self.station_name,
+            "arrival_time": self.arrival_time,
+            "departure_time": self.departure_time,
+            "track": self.track,
+        }
+
 
-@dataclass(unsafe_hash=True)
+@dataclass(unsafe_hash=True, slots=True)
 class Train:
     category: str
     number: int
     name: str | None = field(compare=False, hash=False)
-    stops: list[TrainStop] = field(compare=False, hash=False)
+    stops: tuple[TrainStop, ...] = field(compare=False, hash=False)
     params: set[str] = field(compare=False, hash=False, default_factory=set)
 
+    __setstate__ = dataclass_setstate
+
     def __str__(self) -> str:
         return f"{self.category} {self.number}{f' "{self.name}"' if self.name else ''}"
+
+    def to_dict(self) -> dict:
+        return {
+            "category": self.category,
+            "number": self.number,
+            "name": self.name,
+            "stops": self.stops,
+            "params": list(self.params),
+        }
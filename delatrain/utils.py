@@ -1,5 +1,7 @@
 from time import strftime
+from dataclasses import fields, MISSING
 from functools import wraps
+from threading import Lock
 from typing import Callable, TYPE_CHECKING
 
 
@@ -8,15 +10,36 @@ def log(message: str) -> None:
     print(f"[{timestamp}]  {message}")
 
 
+def dataclass_setstate(self, state: dict | tuple | list) -> None:  # also loads pickles from before slots were added
+    if isinstance(state, tuple):  # (None, slots) from object.__getstate__
+        state = state[1]
+    elif isinstance(state, list):  # field values from the frozen dataclass __getstate__
+        state = {f.name: value for f, value in zip(fields(self), state)}
+    for f in fields(self):
+        if f.name in state:
+            value = state[f.name]
+        elif f.default_factory is not MISSING:
+            value = f.default_factory()
+        elif f.default is not MISSING:
+            value = f.default
+        else:
+            continue
+        object.__setattr__(self, f.name, value)
+
+
 def oneshot_cache[R, **P](func: Callable[P, R]) -> Callable[P, R]:
     if TYPE_CHECKING:  # silence all warnings
         raise NotImplementedError
 
+    lock = Lock()  # concurrent first calls wait for a single run, e.g. with a background prefetch
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         if not wrapper.has_run:
-            wrapper.result = func(*args, **kwargs)
-            wrapper.has_run = True
+            with lock:
+                if not wrapper.has_run:
+                    wrapper.result = func(*args, **kwargs)
+                    wrapper.has_run = True
         return wrapper.result
 
     wrapper.has_run = False
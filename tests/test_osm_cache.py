@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from geopandas import GeoDataFrame
+from shapely.geometry import Point
+from delatrain.data_sources import osm
+from delatrain.structures.position import Position
+
+
+class StationCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.cache_file = os.path.join(folder.name, "stations.pkl")
+        gdf = GeoDataFrame({"name": ["A", "B"], "geometry": [Point(19.0, 50.0), Point(20.0, 51.0)]})
+        self.query = mock.Mock(return_value=gdf)
+        for patch in (
+            mock.patch.object(osm, "_STATIONS_CACHE_FILE", self.cache_file),
+            mock.patch.object(osm.osmnx.settings, "cache_folder", folder.name),
+            mock.patch.object(osm.osmnx, "features_from_place", self.query),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self._reset()
+        self.addCleanup(self._reset)
+
+    @staticmethod
+    def _reset() -> None:
+        osm._all_stations.has_run = False
+        osm._all_stations.result = None
+
+    def test_interrupted_prefetch_is_rebuilt(self) -> None:
+        for path in (self.cache_file, f"{self.cache_file}.tmp"):  # a prefetch killed mid-write
+            with open(path, "wb") as f:
+                f.write(b"\x80\x05\x95")
+        osm.prefetch_stations()
+        self.assertEqual(osm.get_stations_by_names(["A"])["A"].location, Position(50.0, 19.0))
+        self.assertEqual(self.query.call_count, 1)
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_file)), ["stations.pkl"])
+
+        self._reset()
+        self.assertEqual(osm.get_stations_by_names(["B"])["B"].location, Position(51.0, 20.0))
+        self.assertEqual(self.query.call_count, 1)  # served from the rewritten cache
+
+
+if __name__ == "__main__":
+    unittest.main()
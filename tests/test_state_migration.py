@@ -0,0 +1,91 @@
+import pickle
+import unittest
+from datetime import date, time
+from delatrain.algorithm import ScraperState
+from delatrain.structures.position import Position
+from delatrain.structures.stations import Station
+from delatrain.structures.trains import Train, TrainStop, TrainSummary
+
+
+def _baseline_state() -> dict:  # __dict__ of a state pickled before the scraper helpers were added
+    a = Station("A", Position(50.0, 19.0))
+    b = Station("B", Position(50.5, 19.5))
+    c = Station("C", Position(51.0, 20.0))
+    stops = [TrainStop("A", None, time(8, 0), None), TrainStop("B", time(9, 0), None, None)]
+    train = Train("IC", 1, None, stops)
+    blacklisted = Train("IC", 2, None, [TrainStop("C", None, time(10, 0), None)])
+    return {
+        "day": date(2025, 3, 9),
+        "rail_interval": 0,
+        "default_max_speed": 0,
+        "banned_categories": set(),
+        "stations_to_locate": set(),
+        "stations_to_scrape": {c},
+        "trains_to_scrape": [],
+        "broken_stations": set(),
+        "all_stops": {stop: train for stop in stops},
+        "blacklisted_trains": [blacklisted],
+        "stations": {a, b},
+        "trains": [train],
+        "rails_to_find": [],
+        "rails_to_simplify": {},
+        "trains_to_analyze": [],
+        "broken_train_paths": [],
+        "rails": {},
+        "routing_rules": {},
+    }
+
+
+def _load_baseline() -> ScraperState:
+    state = object.__new__(ScraperState)
+    state.__setstate__(_baseline_state())  # what unpickling a baseline state does
+    return pickle.loads(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class StateMigrationTest(unittest.TestCase):
+    def test_stations_keyed_by_name(self) -> None:
+        state = _load_baseline()
+        self.assertEqual(sorted(state.stations), ["A", "B"])
+        self.assertEqual(state.stations["A"].location, Position(50.0, 19.0))
+        self.assertEqual(list(state.stations_to_scrape), ["C"])
+        self.assertEqual(state._choose_stations_to_scrape(1)[0].name, "C")
+
+    def test_stops_by_train_rebuilt(self) -> None:
+        state = _load_baseline()
+        train = state.trains[0]
+        self.assertEqual(state.stops_by_train, {train: set(train.stops)})
+        self.assertTrue(all(state.all_stops[stop] is train for stop in state.stops_by_train[train]))
+
+    def test_trains_by_station_rebuilt(self) -> None:
+        state = _load_baseline()
+        train = state.trains[0]
+        self.assertEqual(state.trains_by_station, {"A": {train}, "B": {train}})
+        state.broken_stations.add("B")
+        trains_to_delete, stations_to_delete = state._cascade_station_deletion("B")
+        self.assertEqual(trains_to_delete, [train])
+        self.assertEqual(stations_to_delete, ["B"])
+        state._remove_train(train)
+        self.assertEqual(state.trains_by_station, {"A": set(), "B": set()})
+
+    def test_known_trains_rebuilt(self) -> None:
+        state = _load_baseline()
+        self.assertEqual(state.known_trains, {("IC", 1), ("IC", 2)})
+        state._station_pages = {"C": [TrainSummary("IC", 1, "u1", ""), TrainSummary("IC", 5, "u5", "")]}
+        state._scrape_station(1)
+        self.assertEqual(state.trains_to_scrape, [TrainSummary("IC", 5, "u5", "")])
+
+    def test_duplicate_subtrain_after_resume(self) -> None:
+        state = _load_baseline()
+        found = state.trains[0]
+        duplicate = Train(
+            "IC", 3, None, [TrainStop("A", None, time(8, 0), None), TrainStop("B", time(9, 0), None, None)]
+        )
+        self.assertIs(state._handle_duplicate_subtrain(duplicate), found)
+        self.assertEqual(state.trains, [])
+        self.assertEqual(state.all_stops, {})
+        self.assertEqual(state.trains_by_station, {"A": set(), "B": set()})
+        self.assertIn(("IC", 3), state.known_trains)
+
+
+if __name__ == "__main__":
+    unittest.main()
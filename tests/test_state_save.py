@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+from datetime import date
+from unittest import mock
+from delatrain import main
+from delatrain.algorithm import ScraperState
+
+
+class StateSaveTest(unittest.TestCase):
+    def setUp(self) -> None:
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        files = {
+            "OUTPUT_DIR": self.folder,
+            "STATE_FILE": os.path.join(self.folder, "state.pkl"),
+            "STATE_FILE_BACKUP": os.path.join(self.folder, "backup.pkl"),
+            "STATE_FILE_TEMP": os.path.join(self.folder, "state.pkl.tmp"),
+            "STATE_FILE_BACKUP_TEMP": os.path.join(self.folder, "backup.pkl.tmp"),
+        }
+        for name, path in files.items():
+            patch = mock.patch.object(main, name, path)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    @staticmethod
+    def _save(station: str) -> None:
+        main.graceful_shutdown(lambda _: None, ScraperState(date(2025, 3, 9), station))
+
+    def test_backup_rotation(self) -> None:
+        self._save("A")
+        self._save("B")
+        self.assertEqual(main.read_state().stations_to_locate, {"B"})  # type: ignore
+        with mock.patch.object(main, "STATE_FILE", main.STATE_FILE_BACKUP):
+            self.assertEqual(main.read_state().stations_to_locate, {"A"})  # type: ignore
+        self.assertEqual(sorted(os.listdir(self.folder)), ["backup.pkl", "state.pkl"])
+
+    def test_state_kept_when_interrupted_before_final_replace(self) -> None:
+        self._save("A")
+        replace = os.replace
+
+        def fail_on_state(src: str, dst: str) -> None:
+            if dst == main.STATE_FILE:
+                raise KeyboardInterrupt
+            replace(src, dst)
+
+        with mock.patch.object(main.os, "replace", fail_on_state), self.assertRaises(KeyboardInterrupt):
+            self._save("B")
+        self.assertEqual(main.read_state().stations_to_locate, {"A"})  # type: ignore
+
+
+if __name__ == "__main__":
+    unittest.main()